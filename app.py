@@ -1,11 +1,26 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, stream_template, stream_with_context
 from pymongo import MongoClient, DESCENDING
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+import sys
+import signal
 import logging
+import functools
+import itertools
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
 import hmac
 import hashlib
+import orjson
+import queue
+import threading
+import atexit
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId, Int64
+from cachetools import TTLCache
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+from pymongo.write_concern import WriteConcern
 
 # Initial setup
 load_dotenv()
@@ -16,6 +31,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
+# Compiled templates are cached on disk and shared by every worker process.
+# Jinja's default directory is private to the current user (0700, owner
+# checked); a custom JINJA_CACHE_DIR must meet the same bar because cached
+# bytecode is executed on load.
+_jinja_cache_dir = os.getenv("JINJA_CACHE_DIR")
+if _jinja_cache_dir:
+    os.makedirs(_jinja_cache_dir, mode=0o700, exist_ok=True)
+    _cache_stat = os.stat(_jinja_cache_dir)
+    if _cache_stat.st_uid != os.getuid() or _cache_stat.st_mode & 0o077:
+        raise RuntimeError(f"Refusing insecure JINJA_CACHE_DIR: {_jinja_cache_dir}")
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=_jinja_cache_dir)
+else:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+app.jinja_env.auto_reload = os.getenv("FLASK_DEBUG", "false").lower() == "true"
+
 # Security headers
 @app.after_request
 def add_security_headers(response):
@@ -24,131 +54,409 @@ def add_security_headers(response):
     response.headers['X-XSS-Protection'] = '1; mode=block'
     return response
 
-# MongoDB connection helper
-def get_db():
-    """Connect to MongoDB with enhanced settings"""
+@app.template_filter("iso_time")
+def iso_time(ts_ns):
+    """Render a nanosecond epoch timestamp as ISO 8601 (UTC)"""
+    if isinstance(ts_ns, datetime):  # legacy events not yet migrated by init-db
+        return ts_ns.replace(tzinfo=timezone.utc).isoformat()
+    return datetime.fromtimestamp(ts_ns / 1e9, tz=timezone.utc).isoformat()
+
+def _json_response(payload, status=200):
+    """Serialize a response body with orjson"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
+
+# MongoDB connection helpers
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """Process-wide MongoClient with a bounded, tuned connection pool"""
     try:
         client = MongoClient(
             os.getenv("MONGODB_URI"),
             connectTimeoutMS=10000,
             serverSelectionTimeoutMS=10000,
-            maxPoolSize=50,
+            maxPoolSize=int(os.getenv("MONGO_POOL_MAX", "50")),
+            minPoolSize=int(os.getenv("MONGO_POOL_MIN", "5")),
+            maxIdleTimeMS=60000,
+            waitQueueTimeoutMS=2000,
+            compressors="zstd,zlib",
             retryWrites=True,
             tls=True
         )
-        
+
         # Verify connection
         client.admin.command('ping')
         logger.info("Successfully connected to MongoDB")
-        
-        db = client[os.getenv("MONGO_DB_NAME", "webhook_db")]
-        
-        # Create indexes
-        db.events.create_index([("timestamp", DESCENDING)])
-        db.events.create_index("repository")
-        db.events.create_index("type")
-        
-        return db
+
+        return client
     except Exception as e:
         logger.critical(f"MongoDB connection failed: {str(e)}")
         raise
 
+def get_db():
+    """Database handle backed by the shared client"""
+    return get_client()[os.getenv("MONGO_DB_NAME", "webhook_db")]
+
+def ensure_events_collection(database):
+    """Create events as a capped collection if it doesn't exist yet"""
+    if "events" in database.list_collection_names():
+        return False
+    try:
+        # Append-only log with bounded retention: oldest events are evicted
+        database.create_collection(
+            "events",
+            capped=True,
+            size=int(os.getenv("EVENTS_CAP_BYTES", 2**30)),
+            max=int(os.getenv("EVENTS_CAP_DOCS", 1_000_000))
+        )
+    except CollectionInvalid:
+        return False  # another worker created it first
+    except OperationFailure as e:
+        if e.code != 48:  # NamespaceExists
+            raise
+        return False
+    logger.info("Created capped events collection")
+    return True
+
+@app.cli.command("init-db")
+def init_db():
+    """Create the capped events collection and its indexes (run once per deployment)"""
+    database = get_db()
+    if not ensure_events_collection(database) and not database.events.options().get("capped"):
+        logger.warning("Existing events collection is not capped; leaving it as is")
+
+    events = database.events
+
+    # Events stored before the Int64 switch hold BSON Dates, which sort above
+    # every number; convert them to nanoseconds so the newest-first list is
+    # ordered correctly (same 8-byte width, so safe on capped collections)
+    for field in ("timestamp", "received_at"):
+        result = events.update_many(
+            {field: {"$type": "date"}},
+            [{"$set": {field: {"$multiply": [{"$toLong": f"${field}"}, 1_000_000]}}}]
+        )
+        if result.modified_count:
+            logger.info(f"Migrated {result.modified_count} legacy {field} values to Int64")
+
+    events.create_index(
+        [("timestamp", DESCENDING), ("type", 1), ("author", 1), ("repository", 1), ("branch", 1)],
+        name="cover_list"
+    )
+    # Superseded by cover_list, which has timestamp as its prefix
+    if "timestamp_-1" in events.index_information():
+        events.drop_index("timestamp_-1")
+    events.create_index("repository")
+    events.create_index("type")
+    logger.info("Created event indexes")
+
 db = get_db()
+# Must exist before the flusher's first insert, which would otherwise create
+# an uncapped collection implicitly
+ensure_events_collection(db)
+app.config["MONGO_CLIENT"] = get_client()
+app.config["MONGO_DB"] = db
+
+# Rendered /events pages, keyed by (page, limit) and cleared on every flush
+EVENTS_CACHE = TTLCache(maxsize=64, ttl=int(os.getenv("EVENTS_CACHE_TTL", 3)))
+_events_cache_lock = threading.Lock()
+_events_cache_generation = 0
+
+def _invalidate_events_cache():
+    """Drop cached pages and stop in-flight renders from caching stale ones"""
+    global _events_cache_generation
+    with _events_cache_lock:
+        _events_cache_generation += 1
+        EVENTS_CACHE.clear()
+
+# Event batching: webhooks are queued and written by a background flusher
+EVENT_QUEUE = queue.Queue(maxsize=int(os.getenv("EVENT_QUEUE_SIZE", 10000)))
+BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", 500))
+FLUSH_MS = int(os.getenv("EVENT_FLUSH_MS", 200))
+_flusher_stop = threading.Event()
+
+# Acknowledged by the primary but not journaled: errors still surface to the
+# flusher without waiting on a journal commit per batch
+ingest_events = db.get_collection("events", write_concern=WriteConcern(w=1, j=False))
+
+def _requeue(events):
+    """Put failed events back on the queue, dropping them if it is full"""
+    dropped = 0
+    for event in events:
+        try:
+            EVENT_QUEUE.put_nowait(event)
+        except queue.Full:
+            dropped += 1
+    if dropped:
+        logger.error("Event queue full, dropped %d events", dropped)
+
+def _flush(batch, requeue=True):
+    """Write a batch of events, requeueing the ones that failed"""
+    try:
+        ingest_events.insert_many(batch, ordered=False, bypass_document_validation=True)
+        logger.info("Inserted batch of %d events", len(batch))
+        _invalidate_events_cache()
+        return True
+    except BulkWriteError as e:
+        # _id is assigned client-side, so duplicate keys mean already stored
+        failed = [
+            batch[err["index"]] for err in e.details.get("writeErrors", [])
+            if err.get("code") != 11000
+        ]
+        _invalidate_events_cache()
+        if not failed:
+            return True
+        logger.error("Batch insert partially failed: %d of %d events", len(failed), len(batch))
+    except Exception as e:
+        failed = batch
+        logger.error("Batch insert failed: %s", e)
+
+    if requeue:
+        _requeue(failed)
+    else:
+        logger.error("Lost %d events on shutdown", len(failed))
+    return False
+
+def _next_batch():
+    """Collect up to BATCH_SIZE events, waiting at most FLUSH_MS after the first"""
+    try:
+        batch = [EVENT_QUEUE.get(timeout=FLUSH_MS / 1000)]
+    except queue.Empty:
+        return []
+
+    deadline = time.monotonic() + FLUSH_MS / 1000
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(EVENT_QUEUE.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _flusher():
+    """Background loop draining EVENT_QUEUE into MongoDB"""
+    while not _flusher_stop.is_set():
+        batch = _next_batch()
+        if batch and not _flush(batch):
+            # Back off so a database outage doesn't spin the loop
+            _flusher_stop.wait(FLUSH_MS / 1000)
+
+@atexit.register
+def _drain_events():
+    """Flush whatever is still queued when the process exits"""
+    _flusher_stop.set()
+    flusher_thread.join(timeout=5)
+
+    batch = []
+    while True:
+        try:
+            batch.append(EVENT_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+        if len(batch) >= BATCH_SIZE:
+            _flush(batch, requeue=False)
+            batch = []
+    if batch:
+        _flush(batch, requeue=False)
+
+flusher_thread = threading.Thread(target=_flusher, name="event-flusher", daemon=True)
+flusher_thread.start()
+
+# Webhook signature verification: key the HMAC once, copy it per request
+_webhook_secret = os.getenv("GITHUB_WEBHOOK_SECRET")
+_HMAC_TEMPLATE = (
+    hmac.new(_webhook_secret.encode(), digestmod=hashlib.sha256)
+    if _webhook_secret else None
+)
+
+HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="webhook-hmac")
+
+def _verify_signature(body, signature):
+    """Check a hex X-Hub-Signature-256 value against the request body"""
+    try:
+        expected = bytes.fromhex(signature)
+    except ValueError:
+        return False
+    h = _HMAC_TEMPLATE.copy()
+    h.update(body)
+    return hmac.compare_digest(h.digest(), expected)
+
+# Event type specific extractors, keyed by the X-GitHub-Event header.
+# Each field maps to (payload key path, default[, transform]).
+EVENT_SCHEMAS = {
+    "push": {
+        "repository": (("repository", "name"), "unknown"),
+        "author": (("pusher", "name"), "unknown"),
+        "branch": (("ref",), "", "short_ref"),
+        "commit_id": (("head_commit", "id"), None),
+        "commit_message": (("head_commit", "message"), None),
+    },
+    "pull_request": {
+        "repository": (("repository", "name"), "unknown"),
+        "author": (("pull_request", "user", "login"), None),
+        "action": (("action",), None),  # opened, closed, etc.
+        "from_branch": (("pull_request", "head", "ref"), None),
+        "to_branch": (("pull_request", "base", "ref"), None),
+        "pr_number": (("pull_request", "number"), None),
+        "pr_state": (("pull_request", "state"), None),
+    },
+}
+
+_TRANSFORMS = {
+    "short_ref": lambda ref: ref.split("/")[-1],
+}
+
+def _compile_extractor(event_type, schema):
+    """Generate straight-line subscript code for one event schema"""
+    lines = ["def extract(data):", f"    event = {{'type': {event_type!r}}}"]
+    for field, (path, default, *transform) in schema.items():
+        value = "data" + "".join(f"[{key!r}]" for key in path)
+        if transform:
+            value = f"{transform[0]}({value})"
+        lines += [
+            "    try:",
+            f"        event[{field!r}] = {value}",
+            "    except (KeyError, TypeError, AttributeError):",
+            f"        event[{field!r}] = {default!r}",
+        ]
+    lines.append("    return event")
+
+    namespace = dict(_TRANSFORMS)
+    exec(compile("\n".join(lines), f"<extract_{event_type}>", "exec"), namespace)
+    return namespace["extract"]
+
+EVENT_HANDLERS = {
+    event_type: _compile_extractor(event_type, schema)
+    for event_type, schema in EVENT_SCHEMAS.items()
+}
 
 @app.route("/webhook", methods=["POST"])
 def handle_webhook():
     """Process GitHub webhook events with signature verification"""
     try:
-        # Verify webhook secret if present
-        webhook_secret = os.getenv("GITHUB_WEBHOOK_SECRET")
-        if webhook_secret:
-            signature = request.headers.get('X-Hub-Signature-256', '').split('=')[1]
-            computed_signature = hmac.new(
-                webhook_secret.encode(),
-                request.data,
-                hashlib.sha256
-            ).hexdigest()
-            
-            if not hmac.compare_digest(signature, computed_signature):
+        body = request.get_data()
+        github_event = request.headers.get('X-GitHub-Event')
+        extract = EVENT_HANDLERS.get(github_event)
+
+        # Verify webhook secret if present; the digest runs on HASH_POOL while
+        # the payload is parsed below (hashlib releases the GIL on large inputs)
+        signature_check = None
+        if _HMAC_TEMPLATE is not None:
+            algorithm, _, signature = request.headers.get('X-Hub-Signature-256', '').partition('=')
+            if algorithm != 'sha256':
                 logger.warning("Invalid webhook signature")
-                return jsonify({"error": "Invalid signature"}), 403
+                return _json_response({"error": "Invalid signature"}, 403)
+            signature_check = HASH_POOL.submit(_verify_signature, body, signature)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s payload: %d bytes", github_event, len(body))
+
+        data = None
+        if extract is not None:
+            try:
+                data = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                pass
+
+        if signature_check is not None and not signature_check.result():
+            logger.warning("Invalid webhook signature")
+            return _json_response({"error": "Invalid signature"}, 403)
+
+        if extract is None:
+            logger.info("Unsupported event type: %s", github_event)
+            return _json_response({"error": "Unsupported event"}, 400)
 
-        data = request.get_json()
         if not data:
             logger.warning("Received empty payload")
-            return jsonify({"error": "Invalid payload"}), 400
+            return _json_response({"error": "Invalid payload"}, 400)
 
         # Base event structure
+        now = Int64(time.time_ns())
         event = {
-            "timestamp": datetime.utcnow(),
-            "repository": data.get("repository", {}).get("name", "unknown"),
-            "received_at": datetime.utcnow()
+            "_id": ObjectId(),
+            "timestamp": now,
+            "received_at": now
         }
 
         # Event type specific processing
-        if "commits" in data:  # Push event
-            event.update({
-                "type": "push",
-                "author": data.get("pusher", {}).get("name", "unknown"),
-                "branch": data.get("ref", "").split("/")[-1],
-                "commit_id": data.get("head_commit", {}).get("id"),
-                "commit_message": data.get("head_commit", {}).get("message")
-            })
-        elif "pull_request" in data:  # PR event
-            pr = data["pull_request"]
-            event.update({
-                "type": "pull_request",
-                "author": pr.get("user", {}).get("login"),
-                "action": data.get("action"),  # opened, closed, etc.
-                "from_branch": pr.get("head", {}).get("ref"),
-                "to_branch": pr.get("base", {}).get("ref"),
-                "pr_number": pr.get("number"),
-                "pr_state": pr.get("state")
-            })
-        else:
-            logger.info(f"Unsupported event type: {data.keys()}")
-            return jsonify({"error": "Unsupported event"}), 400
-
-        # Save to database
-        result = db.events.insert_one(event)
-        logger.info(f"Inserted event with ID: {result.inserted_id}")
-        
-        return jsonify({
-            "status": "success",
-            "event_id": str(result.inserted_id)
-        }), 200
+        event.update(extract(data))
+
+        # Queue for the background flusher
+        try:
+            EVENT_QUEUE.put_nowait(event)
+        except queue.Full:
+            logger.error("Event queue full, rejecting webhook")
+            return _json_response({"error": "Server busy"}, 503)
+
+        return _json_response({
+            "status": "queued",
+            "event_id": str(event["_id"])
+        }, 202)
 
     except Exception as e:
-        logger.error(f"Webhook processing failed: {str(e)}", exc_info=True)
-        return jsonify({"error": "Processing failed"}), 500
+        logger.error("Webhook processing failed: %s", e, exc_info=True)
+        return _json_response({"error": "Processing failed"}, 500)
+
+LIST_PROJECTION = {
+    "_id": 0, "timestamp": 1, "type": 1, "author": 1, "repository": 1, "branch": 1
+}
 
 @app.route("/events")
 def show_events():
     """Display recent events with pagination"""
     try:
-        limit = min(int(request.args.get('limit', 50)), 100)
+        limit = min(max(int(request.args.get('limit', 50)), 1), 100)
         page = max(int(request.args.get('page', 1)), 1)
-        
+
+        key = (page, limit)
+        with _events_cache_lock:
+            cached = EVENTS_CACHE.get(key)
+            generation = _events_cache_generation
+        if cached is not None:
+            return cached
+
         skip = (page - 1) * limit
-        total_events = db.events.count_documents({})
-        
-        events = list(db.events.find()
-                     .sort("timestamp", DESCENDING)
-                     .skip(skip)
-                     .limit(limit))
-        
-        # Convert ObjectId to string for JSON serialization
-        processed_events = []
-        for event in events:
-            event['_id'] = str(event['_id'])
-            processed_events.append(event)
-        
-        return render_template(
+        total_pages = (db.events.estimated_document_count() // limit) + 1
+
+        # Projection matches cover_list so the query is served from the index;
+        # batch_size(limit) fetches the whole page in one round-trip
+        events = (db.events.find({}, LIST_PROJECTION)
+                  .sort("timestamp", DESCENDING)
+                  .skip(skip)
+                  .limit(limit)
+                  .batch_size(limit))
+        # Fetch the first batch before streaming starts so query failures
+        # still reach the 500 path below instead of truncating a 200 page
+        first = next(events, None)
+        rows = itertools.chain([first] if first is not None else [], events)
+
+        # The template is loaded here, so only cursor failures can occur mid-stream
+        page_stream = stream_template(
             "events.html",
-            events=processed_events,
+            events=rows,
             current_page=page,
-            total_pages=(total_events // limit) + 1
+            total_pages=total_pages,
+            limit=limit
         )
+
+        @stream_with_context
+        def generate():
+            # Rows are rendered as the cursor yields them; the full page is
+            # cached only once it has been streamed completely
+            chunks = []
+            try:
+                for chunk in page_stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                logger.error(f"Failed to stream events: {str(e)}")
+                return
+            with _events_cache_lock:
+                # A flush since the query means this page may be stale
+                if generation == _events_cache_generation:
+                    EVENTS_CACHE[key] = "".join(chunks)
+
+        return app.response_class(generate(), mimetype="text/html")
     except Exception as e:
         logger.error(f"Failed to retrieve events: {str(e)}")
         return jsonify({"error": "Failed to retrieve events"}), 500
@@ -161,7 +469,7 @@ def health_check():
         db.command('ping')
         
         # Check collection access
-        event_count = db.events.count_documents({})
+        event_count = db.events.estimated_document_count()
         
         return jsonify({
             "status": "healthy",
@@ -176,43 +484,57 @@ def health_check():
             "error": str(e)
         }), 500
 
+# API documentation served from "/", serialized once at import
+_HOME_DOC = orjson.dumps({
+    "service": "GitHub Webhook Processor",
+    "status": "running",
+    "version": "1.0.0",
+    "endpoints": {
+        "webhook": {
+            "path": "/webhook",
+            "method": "POST",
+            "description": "Accepts GitHub webhook payloads"
+        },
+        "events": {
+            "path": "/events",
+            "method": "GET",
+            "parameters": {
+                "limit": "Number of events to return (max 100)",
+                "page": "Page number"
+            }
+        },
+        "health": {
+            "path": "/health",
+            "method": "GET",
+            "description": "Service health check"
+        }
+    },
+    "documentation": "https://github.com/your-repo/docs"
+})
+
 @app.route("/")
 def home():
     """Root endpoint with API documentation"""
-    return jsonify({
-        "service": "GitHub Webhook Processor",
-        "status": "running",
-        "version": "1.0.0",
-        "endpoints": {
-            "webhook": {
-                "path": "/webhook",
-                "method": "POST",
-                "description": "Accepts GitHub webhook payloads"
-            },
-            "events": {
-                "path": "/events",
-                "method": "GET",
-                "parameters": {
-                    "limit": "Number of events to return (max 100)",
-                    "page": "Page number"
-                }
-            },
-            "health": {
-                "path": "/health",
-                "method": "GET",
-                "description": "Service health check"
-            }
-        },
-        "documentation": "https://github.com/your-repo/docs"
-    })
+    return app.response_class(_HOME_DOC, mimetype="application/json")
 
 # Store application start time
 app_start_time = datetime.utcnow()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))  # <-- this uses Railway's PORT env var if set
-    app.run(
-        host="0.0.0.0",
-        port=port,
-        debug=os.getenv("FLASK_DEBUG", "false").lower() == "true"
-    )
+    if os.getenv("FLASK_DEBUG", "false").lower() == "true":
+        app.run(host="0.0.0.0", port=port, debug=True)
+    else:
+        # Waitress sets TCP_NODELAY on every accepted connection by default
+        # (Adjustments.socket_options), so small JSON responses aren't held
+        # back by Nagle + delayed ACK
+        from waitress import serve
+        # Platforms stop the process with SIGTERM; turn it into SystemExit so
+        # Waitress unwinds and the atexit drain flushes queued events
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        serve(
+            app,
+            host="0.0.0.0",
+            port=port,
+            threads=int(os.getenv("WAITRESS_THREADS", 8))
+        )